@@ -5,4 +5,7 @@ class DownloadError(Exception):
     pass
 
 class LoginError(Exception):
+    pass
+
+class TimeoutError(Exception):
     pass
\ No newline at end of file
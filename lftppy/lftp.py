@@ -2,37 +2,69 @@ from utils import spawn
 from . import exc
 from pexpect import EOF, TIMEOUT
 import re
+import time
 
 
 class LFTP(object):
 
     # matches [n] where n is an integer
     job_id_matcher = re.compile(r'[\s]*\[(\d+)\]')
+    # matches ' n. cmd', a command waiting in the queue
+    queue_entry_matcher = re.compile(r'^\s*(\d+)\.\s+(.*)$')
+    # matches '[n] cmd' or '-[n] cmd', a command the queue is running
+    queue_running_matcher = re.compile(r'^\s*(?:Now executing:)?\s*-?\[(\d+)\]\s+(.*)$')
+    # matches the notice lftp prints when background job n has finished
+    job_done_matcher = re.compile(r'\[(\d+)\] Done \(')
+    # lftp messages that mean the server could not be reached
+    connection_errors = [
+        "Name or service not known",
+        "Could not resolve",
+        "Connection refused",
+        "Fatal error",
+    ]
     # default lftp prompt
     prompt = "lftp .*?>"
 
-    def __init__(self, host, port=None, username=None, password=None, **opts):
+    def __init__(self, host, port=None, username=None, password=None,
+                 recover=True, retries=5, backoff=1, **opts):
         """
 
         :param host: The ftp hostname
         :param port: The port for the ftp service
         :param username:
         :param password:
+        :param recover: reconnect and resume background transfers if the lftp process dies
+        :param retries: how many times to try reconnecting before giving up, at least 1
+        :param backoff: seconds to wait after the first failed attempt, doubled after each one
         :param opts: configuration for the lftp program
         :return:
+        :raises: ValueError if retries is less than 1
         """
+        if retries < 1:
+            raise ValueError("retries must be at least 1, not %r" % (retries,))
         self.host = host
         self.port = port or 21
         self.username = username
         self.password = password
         self.process = None
         self.last_cmd = None
+        self.recover = recover
+        self.retries = retries
+        self.backoff = backoff
+        # background transfers that have not been seen to finish
+        self.transfers = []
+        # the last 'set' command for each variable, replayed after reconnecting
+        self.settings = {}
+        # named queues, each run by its own LFTP instance
+        self.queues = {}
+        self._closed = False
         self.opts = opts
         self._connect(**opts)
 
     def raw(self, string, timeout=-1):
         if not self.process:
             raise exc.ConnectionError()
+        self._ensure_running()
         self.send_input(string)
         output = self.get_output(timeout=timeout)
         return output
@@ -94,22 +126,141 @@ class LFTP(object):
         jobs_output = self.run("jobs")
         # parse jobs output and put into array
         result = self.parse_jobs(jobs_output)
+        self._update_transfers(result)
         return result
 
-    def run(self, cmd, background=False):
+    def _update_transfers(self, jobs):
+        """ Forget the transfers that are no longer running
+        :param jobs: the current jobs, as returned by parse_jobs
+        :return:
+        """
+        for transfer in list(self.transfers):
+            job = jobs.get(transfer.job_no)
+            if job is None or "Done (" in job.text.splitlines()[0]:
+                transfer.done = True
+                self.transfers.remove(transfer)
+
+    def _prune_transfers(self, output):
+        """ Forget the transfers that lftp reported as done in output
+        :param output: text read from the lftp process
+        :return:
+        """
+        done = set(int(n) for n in self.job_done_matcher.findall(output))
+        for transfer in list(self.transfers):
+            if transfer.job_no in done:
+                transfer.done = True
+                self.transfers.remove(transfer)
+
+    @staticmethod
+    def parse_queue(text):
+        """ Transforms the result from the 'queue' lftp command
+        to an array of queue entries.
+        The format of the 'queue' command is:
+        [n] queue (site)
+        site/cwd
+            Now executing: [m] text_m
+                -[m+1] text_m+1
+            Commands queued:
+             1. text_1
+             2. text_2
+        :param text: The text to parse
+        :return: a list of QueueEntry, running commands first
+        """
+        running = []
+        queued = []
+        executing = False
+        for line in text.splitlines():
+            if "Now executing:" in line:
+                executing = True
+            elif "Commands queued:" in line:
+                executing = False
+            matches = LFTP.queue_entry_matcher.match(line)
+            if matches and not executing:
+                queued.append(QueueEntry(matches.group(2).strip(), position=int(matches.group(1))))
+                continue
+            matches = LFTP.queue_running_matcher.match(line)
+            if matches and executing:
+                # the command is followed by its progress, e.g. 'mirror vax -- 2.8M/754M (0%)'
+                cmd, _, status = matches.group(2).partition(" -- ")
+                running.append(QueueEntry(cmd.strip(), job_no=int(matches.group(1)),
+                                          status=status.strip() or None))
+        return running + queued
+
+    def run(self, cmd, background=False, timeout=-1):
         """
         :param cmd: The command to run on the ftp site
         :param background: run the command in the background
+        :param timeout: see get_output
         :return:
         """
-        if not self.is_running():
-            raise exc.ConnectionError()
+        self._ensure_running()
+        if cmd.startswith("set "):
+            names = [arg for arg in cmd.split()[1:] if not arg.startswith('-')]
+            if names:
+                self.settings[names[0]] = cmd
         if background:
             cmd += " &"
+        if timeout != -1:
+            # get_output stops at the first prompt, so it can't be a stale one
+            self._flush()
         self.send_input(cmd)
-        output = self.get_output()
+        output = self.get_output(timeout=timeout)
         return output
 
+    def _flush(self):
+        """ Read whatever earlier commands left behind, such as repeated prompts
+        :return:
+        """
+        output = ""
+        while self.process.expect([self.prompt, EOF, TIMEOUT], timeout=0) == 0:
+            output += self.process.before
+        output += self.process.before or ""
+        self._prune_transfers(output)
+
+    def _ensure_running(self):
+        """ Recover from an lftp process that died on its own
+        :return:
+        :raises: exc.ConnectionError if the process is not running and can't be restarted
+        """
+        if self.is_running():
+            return
+        if self._closed or not self.recover:
+            raise exc.ConnectionError()
+        delay = self.backoff
+        error = exc.ConnectionError()
+        for attempt in range(self.retries):
+            try:
+                self.reconnect()
+                return
+            except (exc.ConnectionError, exc.LoginError) as e:
+                error = e
+                if attempt < self.retries - 1:
+                    time.sleep(delay)
+                    delay *= 2
+        raise error
+
+    def _start_transfer(self, transfer, resume=False):
+        """ Run a transfer in the background and record its job number
+        :param transfer: Transfer
+        :param resume: continue the transfer instead of starting it
+        :return:
+        """
+        cmd = transfer.resume_cmd if resume else transfer.cmd
+        transfer.output = self.run(cmd, background=True)
+        # '[n] cmd', and not the 'Done' notice of some other job
+        matcher = re.compile(r'^\s*\[(\d+)\]\s+%s' % re.escape(cmd), re.MULTILINE)
+        matches = matcher.search(transfer.output)
+        if matches:
+            transfer.job_no = int(matches.group(1))
+        else:
+            # fall back to the most recent job running this command
+            jobs = self.parse_jobs(self.run("jobs"))
+            job_nos = [n for n, job in jobs.items()
+                       if cmd in job.text and "Done (" not in job.text.splitlines()[0]]
+            transfer.job_no = max(job_nos) if job_nos else None
+        if transfer not in self.transfers:
+            self.transfers.append(transfer)
+
     def _connect(self, **opts):
         """
         Attempt to connect to ftp server
@@ -119,6 +270,9 @@ class LFTP(object):
         cmd = ['lftp']
         cmd += ['-p', str(self.port)]
         cmd += ['-u', "%s,%s" % (self.username, self.password), self.host]
+        if self.process is not None and not self.process.closed:
+            # release the pty of the previous process
+            self.process.close(force=True)
         process = spawn(" ".join(cmd))
         self.process = process
         # ensure that we can connect
@@ -126,8 +280,7 @@ class LFTP(object):
         output = self.process.before
         if index == 0:
             output = output + self.process.after
-        if "Name or service not known" in output:
-            raise exc.ConnectionError(output)
+        self._check_connected(output)
         # ensure that we are logged in
         # We do this by trying to send a command and
         # testing to see if there's a login error
@@ -135,7 +288,18 @@ class LFTP(object):
         index = self.process.expect([self.prompt, EOF, TIMEOUT])
         output = self.process.before
         if "Login failed" in output:
+            self.process.close(force=True)
             raise exc.LoginError(output)
+        self._check_connected(output)
+        if index != 0:
+            self.process.close(force=True)
+            raise exc.ConnectionError(output)
+
+    def _check_connected(self, output):
+        for error in self.connection_errors:
+            if error in output:
+                self.process.close(force=True)
+                raise exc.ConnectionError(output)
 
     def is_running(self):
         return self.process.isalive()
@@ -147,14 +311,57 @@ class LFTP(object):
         """
         if job_no is not None:
             self.run("kill %d" % job_no)
+            self._forget_transfers(job_no)
         else:
+            self._closed = True
+            self._forget_transfers()
+            for session in self.queues.values():
+                session.kill()
             self.process.kill(9)
 
+    def _forget_transfers(self, job_no=None):
+        """ Stop tracking the transfer of job job_no, or all transfers, so
+        that they are not resumed
+        :param job_no:
+        :return:
+        """
+        for transfer in list(self.transfers):
+            if job_no is None or transfer.job_no == job_no:
+                transfer.done = True
+                self.transfers.remove(transfer)
+
     def reconnect(self):
+        """ Start a new lftp process, restoring the settings and resuming
+        the background transfers of the previous one.  Transfers stopped with
+        kill or disconnect are not resumed.  Named queues that are not running
+        are reconnected as well.
+        :return:
+        """
         self.last_cmd = None
+        if self.process is not None and not self.process.closed:
+            # pick up the 'Done' notices the old process printed before it died
+            self.process.expect([EOF, TIMEOUT], timeout=0)
+            self._prune_transfers(self.process.before or "")
         self._connect(**self.opts)
+        self._closed = False
+        for session in self.queues.values():
+            if not session.is_running():
+                session.reconnect()
+        for cmd in list(self.settings.values()):
+            self.run(cmd)
+        for transfer in list(self.transfers):
+            try:
+                self._start_transfer(transfer, resume=True)
+            except exc.DownloadError as e:
+                transfer.output = str(e)
+                transfer.done = True
+                self.transfers.remove(transfer)
 
     def disconnect(self):
+        self._closed = True
+        self._forget_transfers()
+        for session in self.queues.values():
+            session.disconnect()
         self.process.terminate(force=True)
 
     def send_input(self, line):
@@ -187,9 +394,12 @@ class LFTP(object):
     def get_output(self, job_id=None, timeout=-1):
         """ Assumes successful connection to the ftp server
         :param job_id:
-        :param timeout:
+        :param timeout: seconds to wait for the foreground command to finish,
+                None to wait as long as it takes.  With the default of -1 the
+                output is collected until lftp has been quiet for a second
         :return: The latest output of the job with id job_id,
                 or the current foreground process if no job_id is given
+        :raises: exc.TimeoutError if the command is still running after timeout
         """
         if job_id is None:
             matches = [
@@ -206,12 +416,20 @@ class LFTP(object):
             max_tries = 5
             tries = 0
             result = ""
+            if timeout != -1:
+                # wait for the command to finish, run has flushed any stale prompts
+                i = self.process.expect([self.prompt, EOF, TIMEOUT], timeout=timeout)
+                result += self.process.before
+                if i == 2:
+                    raise exc.TimeoutError(result)
+                waiting = False
             while waiting:
                 i = self.process.expect(matches, timeout=1)
                 if i == matches.index(TIMEOUT) or tries > max_tries:
                     waiting = False
                 tries += 1
                 result += self.process.before
+            self._prune_transfers(result)
             # TODO(minadyn@gmail.com) handle EOF and TIMEOUT cases
         else:
             result = self.jobs[job_id].text
@@ -222,8 +440,24 @@ class LFTP(object):
         cmd = ['ls', '-la']
         return self.run(" ".join(cmd))
 
+    @staticmethod
+    def _get_cmd(rfile, lfile, delete_src=False, delete_target=False, mode="binary",
+                 resume=False):
+        cmd_parts = ['get']
+        if resume:
+            cmd_parts.append('-c')
+        if delete_src:
+            cmd_parts.append('-E')
+        if delete_target and not resume:
+            cmd_parts.append('-e')
+        if mode == 'ascii':
+            cmd_parts.append('-a')
+        cmd_parts.append(rfile)
+        cmd_parts += ['-o', lfile]
+        return " ".join(cmd_parts)
+
     def get(self, rfile, lfile, delete_src=False, delete_target=False, mode="binary",
-            background=False):
+            background=False, timeout=-1):
         """ Get a single file
         :param rfile:
         :param lfile:
@@ -231,17 +465,25 @@ class LFTP(object):
         :param delete_target:
         :param mode:
         :param background:
-        :return:
+        :param timeout: see get_output, ignored for background transfers
+        :return: the command output, or a Transfer if background is set
         """
-        cmd_parts = ['get']
-        if delete_src:
-            cmd_parts.append('-E')
-        if mode == 'ascii':
-            cmd_parts.append('-a')
-        cmd_parts.append(rfile)
-        cmd_parts += ['-o', lfile]
-        cmd = " ".join(cmd_parts)
-        return self.run(cmd, background=background)
+        args = (rfile, lfile, delete_src, delete_target, mode)
+        if background:
+            transfer = Transfer(self._get_cmd(*args), self._get_cmd(*args, resume=True))
+            self._start_transfer(transfer)
+            return transfer
+        return self.run(self._get_cmd(*args), timeout=timeout)
+
+    @staticmethod
+    def _mirror_cmd(source, target, parallel=None, resume=False):
+        cmd = ['mirror']
+        if resume:
+            cmd.append('--continue')
+        cmd += [source, target]
+        if parallel:
+            cmd += ["--parallel=%s" % str(parallel)]
+        return " ".join(cmd)
 
     def mirror(self, source, target, parallel=None, background=False):
         """
@@ -250,14 +492,14 @@ class LFTP(object):
         :param target:
         :param parallel: how many files to download in parallel
         :param background: run the process in the background
-        :return:
+        :return: the command output, or a Transfer if background is set
         """
-        cmd = ['mirror', source, target]
-        if parallel:
-            cmd += ["--parallel=%s" % str(parallel)]
+        args = (source, target, parallel)
         if background:
-            cmd += ['&']
-        return self.run(" ".join(cmd))
+            transfer = Transfer(self._mirror_cmd(*args), self._mirror_cmd(*args, resume=True))
+            self._start_transfer(transfer)
+            return transfer
+        return self.run(self._mirror_cmd(*args))
 
     def rm(self, filename, recurse=False):
         """ Remove a single file
@@ -272,6 +514,150 @@ class LFTP(object):
         cmd.append(filename)
         return self.run(" ".join(cmd))
 
+    def add_queue(self, name, parallel=1):
+        """ Create a named queue.
+        lftp has one queue per site, so each named queue gets its own lftp
+        process and runs up to parallel commands independently of the others.
+        Adding a queue under an existing name replaces it, disconnecting the
+        old one.
+        :param name:
+        :param parallel: how many queued commands to run at once
+        :return:
+        """
+        if name in self.queues:
+            self.queues.pop(name).disconnect()
+        session = type(self)(self.host, self.port, self.username, self.password,
+                             recover=self.recover, retries=self.retries,
+                             backoff=self.backoff, **self.opts)
+        self.queues[name] = session
+        self.queue_parallel(parallel, queue=name)
+
+    def _queue_session(self, queue):
+        if queue is None:
+            return self
+        return self.queues[queue]
+
+    def _queue(self, args, queue=None):
+        return self._queue_session(queue).run(("queue " + args).strip())
+
+    def queue_parallel(self, parallel, queue=None):
+        """ Set how many commands of a queue run at once
+        :param parallel:
+        :param queue: name of the queue, the default queue if None
+        :return:
+        """
+        return self._queue_session(queue).run("set cmd:queue-parallel %d" % parallel)
+
+    def enqueue(self, cmd, queue=None, position=None):
+        """ Add a command to a queue
+        :param cmd: The command to run on the ftp site
+        :param queue: name of the queue, the default queue if None
+        :param position: insert before this 1-based queue position instead of at the end
+        :return:
+        """
+        args = cmd
+        if position is not None:
+            args = "-n %d %s" % (position, cmd)
+        return self._queue(args, queue=queue)
+
+    def queue_get(self, rfile, lfile, delete_src=False, delete_target=False, mode="binary",
+                  queue=None, position=None):
+        """ Queue the download of a single file, see get and enqueue
+        """
+        cmd = self._get_cmd(rfile, lfile, delete_src, delete_target, mode)
+        return self.enqueue(cmd, queue=queue, position=position)
+
+    def queue_mirror(self, source, target, parallel=None, queue=None, position=None):
+        """ Queue a mirror, see mirror and enqueue
+        """
+        cmd = self._mirror_cmd(source, target, parallel)
+        return self.enqueue(cmd, queue=queue, position=position)
+
+    def list_queue(self, queue=None):
+        """ Get the contents of a queue
+        :param queue: name of the queue, the default queue if None
+        :return: list of QueueEntry
+        """
+        return self.parse_queue(self._queue("", queue=queue))
+
+    def queue_delete(self, position, queue=None):
+        """ Remove a waiting command from a queue
+        :param position: 1-based queue position
+        :param queue: name of the queue, the default queue if None
+        :return:
+        """
+        return self._queue("-d %d" % position, queue=queue)
+
+    def queue_move(self, position, to=None, queue=None):
+        """ Move a waiting command
+        :param position: 1-based queue position of the command
+        :param to: move it before this position, or to the end if None
+        :param queue: name of the queue, the default queue if None
+        :return:
+        """
+        args = "-m %d" % position
+        if to is not None:
+            args += " %d" % to
+        return self._queue(args, queue=queue)
+
+    @staticmethod
+    def _reorder_moves(order):
+        """ Work out the queue positions to move to the front, one after
+        the other, so that the commands at order come first in that order
+        :param order: 1-based queue positions
+        :return: list of positions
+        :raises: ValueError if a position appears more than once
+        """
+        if not order:
+            return []
+        if len(set(order)) != len(order):
+            raise ValueError("duplicate queue positions in %r" % (order,))
+        current = list(range(1, max(order) + 1))
+        moves = []
+        for position in reversed(order):
+            idx = current.index(position)
+            moves.append(idx + 1)
+            current.insert(0, current.pop(idx))
+        return moves
+
+    def queue_reorder(self, order, queue=None):
+        """ Reprioritise waiting commands.  The commands at the positions in
+        order are moved to the front of the queue in that order, the others
+        keep their relative order after them.
+        :param order: 1-based queue positions
+        :param queue: name of the queue, the default queue if None
+        :return:
+        """
+        moves = ["queue -m %d 1" % position for position in self._reorder_moves(order)]
+        if moves:
+            # a single round trip for all the moves
+            self._queue_session(queue).run(" ; ".join(moves))
+
+    def queue_stop(self, queue=None):
+        """ Stop starting queued commands, e.g. while filling or reordering the queue
+        """
+        return self._queue("stop", queue=queue)
+
+    def queue_start(self, queue=None):
+        """ Start running queued commands again after queue_stop
+        """
+        return self._queue("start", queue=queue)
+
+class Transfer(object):
+    """ A background transfer.  The same instance keeps tracking the
+    transfer after it has been resumed in a new lftp process.
+    """
+    def __init__(self, cmd, resume_cmd):
+        self.cmd = cmd
+        self.resume_cmd = resume_cmd
+        self.job_no = None
+        self.output = ""
+        self.done = False
+
+    def __str__(self):
+        return self.cmd
+
+
 class Job(object):
     def __init__(self, job_no, text):
         self.job_no = job_no
@@ -283,3 +669,21 @@ class Job(object):
 
     def parse(self, text):
         pass
+
+
+class QueueEntry(object):
+    """ A command in an lftp queue.  Waiting commands have a position,
+    running commands have a job number and their progress as status instead.
+    """
+    def __init__(self, cmd, position=None, job_no=None, status=None):
+        self.cmd = cmd
+        self.position = position
+        self.job_no = job_no
+        self.status = status
+
+    @property
+    def running(self):
+        return self.job_no is not None
+
+    def __str__(self):
+        return self.cmd
@@ -0,0 +1,393 @@
+from . import exc
+from six.moves import queue
+from collections import defaultdict
+import json
+import os
+import re
+import threading
+
+
+def _quote(path):
+    """ Quote a path for use as a single lftp command argument
+    """
+    return '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _parent(relpath):
+    return relpath.rsplit('/', 1)[0] if '/' in relpath else ""
+
+
+def _join(*parts):
+    return "/".join(p.strip('/') for p in parts if p)
+
+
+class SyncIndex(object):
+    """ Persistent record of the local target tree.
+
+    files maps a path relative to the target to [size, mtime] of the remote
+    file it was downloaded from, dirs maps a relative directory path to the
+    remote mtime it had when it was last listed.
+    """
+
+    def __init__(self, path, files=None, dirs=None):
+        self.path = path
+        self.files = files or {}
+        self.dirs = dirs or {}
+
+    @classmethod
+    def load(cls, path):
+        """ Load the index stored at path, or an empty index if there is none
+        :param path:
+        :return: SyncIndex
+        """
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path) as f:
+            data = json.load(f)
+        return cls(path, data.get('files'), data.get('dirs'))
+
+    @classmethod
+    def scan(cls, path, root):
+        """ Build an index from the files already present under root.
+        Directories are recorded without an mtime so that the next sync lists
+        the whole remote tree, and local mtimes stand in for the remote ones.
+        :param path: where the index will be saved
+        :param root: the local target directory
+        :return: SyncIndex
+        """
+        index = cls(path)
+        skip = set(os.path.abspath(p) for p in (path, path + '.tmp'))
+        for dirpath, dirnames, filenames in os.walk(root):
+            rel_dir = os.path.relpath(dirpath, root).replace(os.sep, '/')
+            if rel_dir == '.':
+                rel_dir = ""
+            if rel_dir:
+                index.dirs[rel_dir] = None
+            for name in filenames:
+                full = os.path.join(dirpath, name)
+                if os.path.abspath(full) in skip:
+                    continue
+                st = os.stat(full)
+                index.files[_join(rel_dir, name)] = [st.st_size, int(st.st_mtime)]
+        return index
+
+    def save(self):
+        """ Write the index, replacing the previous one only once the new
+        one is complete
+        """
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'files': self.files, 'dirs': self.dirs}, f)
+        os.rename(tmp, self.path)
+
+    def forget_dir(self, relpath):
+        """ Drop relpath and all its ancestors so that the next sync lists them again
+        :param relpath: a relative directory path
+        """
+        while True:
+            self.dirs.pop(relpath, None)
+            if not relpath:
+                break
+            relpath = _parent(relpath)
+
+
+class Operation(object):
+    GET = 'get'
+    RM = 'rm'
+    RMDIR = 'rmdir'
+
+    def __init__(self, kind, relpath, size=0, mtime=None):
+        self.kind = kind
+        self.relpath = relpath
+        self.size = size
+        self.mtime = mtime
+
+    def __str__(self):
+        if self.kind == self.GET:
+            return "get %s (%d bytes)" % (self.relpath, self.size)
+        return "%s %s" % (self.kind, self.relpath)
+
+
+class SyncPlan(object):
+    def __init__(self, operations, files, dirs):
+        """
+        :param operations: list of Operation
+        :param files: the files entries of the index once the plan has run
+        :param dirs: the dirs entries of the index once the plan has run
+        """
+        self.operations = operations
+        self.files = files
+        self.dirs = dirs
+
+    @property
+    def gets(self):
+        return [op for op in self.operations if op.kind == Operation.GET]
+
+    @property
+    def removals(self):
+        return [op for op in self.operations if op.kind == Operation.RM]
+
+    @property
+    def dir_removals(self):
+        """ Directories that are gone remotely, deepest first
+        """
+        ops = [op for op in self.operations if op.kind == Operation.RMDIR]
+        return sorted(ops, key=lambda op: op.relpath.count('/'), reverse=True)
+
+    @property
+    def size(self):
+        """ Estimated number of bytes to download
+        """
+        return sum(op.size for op in self.gets)
+
+    def summary(self):
+        return "get %d files (%d bytes), rm %d files" % (
+            len(self.gets), self.size, len(self.removals))
+
+    def __str__(self):
+        lines = [str(op) for op in self.operations]
+        lines.append(self.summary())
+        return "\n".join(lines)
+
+
+class SyncPlanner(object):
+    """ Incrementally mirrors a remote directory into a local one.
+
+    Instead of comparing the whole tree like `mirror`, the planner keeps a
+    SyncIndex of the target.  Every remote directory is listed, since a
+    change deep in the tree only touches the mtime of the directory that
+    holds it, but files are only compared in directories whose mtime differs
+    from the one recorded in the index.  A file rewritten in place without
+    changing its directory's mtime is therefore not picked up; pass
+    rebuild=True to rescan the target and compare every file.
+    """
+
+    # size, epoch mtime and name, as printed by LISTING_CMD.
+    # --filesize leaves the size of directories blank
+    listing_matcher = re.compile(r'^\s*(?:(\d+)\s+)?(\d+)\s+(.+)$')
+    # the notice lftp prints when a background job has finished
+    notice_matcher = re.compile(r'^\s*\[\d+\] Done \(')
+    LISTING_CMD = "cls -1 -s --filesize --date --time-style=+%%s -F %s"
+    INDEX_NAME = '.lftppy-index'
+
+    def __init__(self, session, source, target, index_path=None, rebuild=False):
+        """
+        :param session: LFTP instance used to list the remote tree
+        :param source: the remote directory
+        :param target: the local directory
+        :param index_path: where to keep the index, defaults to a file in target
+        :param rebuild: build the index from the files in target instead of loading it
+        :return:
+        """
+        self.session = session
+        self.source = source
+        self.target = target
+        self.index_path = index_path or os.path.join(target, self.INDEX_NAME)
+        if rebuild:
+            self.index = SyncIndex.scan(self.index_path, target)
+        else:
+            self.index = SyncIndex.load(self.index_path)
+
+    @staticmethod
+    def parse_listing(text):
+        """ Transforms the result of LISTING_CMD into entries.
+        Symbolic links are skipped.
+        :param text: The text to parse
+        :return: a list of (name, is_dir, size, mtime) tuples
+        :raises: exc.DownloadError if text holds anything but listing entries,
+                 such as an lftp error message
+        """
+        result = []
+        for line in text.splitlines():
+            if not line.strip() or SyncPlanner.notice_matcher.match(line):
+                continue
+            matches = SyncPlanner.listing_matcher.match(line)
+            if not matches:
+                raise exc.DownloadError(text)
+            size, mtime, name = matches.groups()
+            if name.endswith('@'):
+                continue
+            is_dir = name.endswith('/')
+            name = name.rstrip('/').rsplit('/', 1)[-1]
+            result.append((name, is_dir, int(size or 0), int(mtime)))
+        return result
+
+    def list_remote(self, relpath):
+        """ List a single remote directory
+        :param relpath: directory relative to the source
+        :return: see parse_listing
+        """
+        path = _join(self.source, relpath) or self.source
+        output = self.session.run(self.LISTING_CMD % _quote(path + '/'), timeout=None)
+        return self.parse_listing(output)
+
+    def plan(self):
+        """ Compare the remote tree against the index.
+        :return: SyncPlan
+        """
+        index = self.index
+        child_files = defaultdict(list)
+        child_dirs = defaultdict(list)
+        for relpath in index.files:
+            child_files[_parent(relpath)].append(relpath)
+        for relpath in index.dirs:
+            if relpath:
+                child_dirs[_parent(relpath)].append(relpath)
+
+        def subtree(relpath):
+            # the indexed files and directories at or below relpath
+            files, dirs, stack = [], [], [relpath]
+            while stack:
+                d = stack.pop()
+                dirs.append(d)
+                files.extend(child_files[d])
+                stack.extend(child_dirs[d])
+            return files, dirs
+
+        operations = []
+        files = {}
+        dirs = {}
+        # the root has no recorded mtime, so its files are always compared
+        stack = [("", True)]
+        while stack:
+            relpath, changed = stack.pop()
+            entries = self.list_remote(relpath)
+            if not relpath and not entries and (child_files[""] or child_dirs[""]):
+                # more likely a failed listing than an emptied source
+                raise exc.DownloadError("empty listing of %s" % self.source)
+            seen_files = set()
+            seen_dirs = set()
+            for name, is_dir, size, mtime in entries:
+                child = _join(relpath, name)
+                if is_dir:
+                    seen_dirs.add(child)
+                    dirs[child] = mtime
+                    stack.append((child, index.dirs.get(child) != mtime))
+                elif changed:
+                    seen_files.add(child)
+                    files[child] = [size, mtime]
+                    if index.files.get(child) != [size, mtime]:
+                        operations.append(Operation(Operation.GET, child, size, mtime))
+            if changed:
+                # anything indexed here that the server no longer lists is gone
+                for f in child_files[relpath]:
+                    if f not in seen_files:
+                        operations.append(Operation(Operation.RM, f))
+            else:
+                for f in child_files[relpath]:
+                    files[f] = index.files[f]
+            for d in child_dirs[relpath]:
+                if d not in seen_dirs:
+                    sub_files, sub_dirs = subtree(d)
+                    for f in sub_files:
+                        operations.append(Operation(Operation.RM, f))
+                    for sub_dir in sub_dirs:
+                        operations.append(Operation(Operation.RMDIR, sub_dir))
+        return SyncPlan(operations, files, dirs)
+
+    def _get(self, session, op, timeout=None):
+        lfile = os.path.join(self.target, *op.relpath.split('/'))
+        ldir = os.path.dirname(lfile)
+        if not os.path.isdir(ldir):
+            try:
+                os.makedirs(ldir)
+            except OSError:
+                # another session may have created it in the meantime
+                if not os.path.isdir(ldir):
+                    raise
+        rfile = _join(self.source, op.relpath)
+        session.get(_quote(rfile), _quote(lfile),
+                    delete_target=os.path.exists(lfile), timeout=timeout)
+
+    def _rm(self, op):
+        lfile = os.path.join(self.target, *op.relpath.split('/'))
+        if os.path.exists(lfile):
+            os.remove(lfile)
+
+    def _rmdir(self, op):
+        ldir = os.path.join(self.target, *op.relpath.split('/'))
+        try:
+            os.rmdir(ldir)
+        except OSError:
+            # missing, or still holding files that were never synced
+            pass
+
+    def execute(self, plan, sessions=None, timeout=None):
+        """ Run the operations of plan and save the updated index.
+        Removals run first, so that a path that turned from a file into a
+        directory or back can be downloaded, then the downloads are spread
+        over sessions, one at a time per session.
+        Failed downloads are dropped from the index, since the local copy may
+        already have been deleted, and failed removals keep their entry.
+        Either way the directory is listed again on the next sync.
+        :param plan: SyncPlan
+        :param sessions: LFTP instances to download with, defaults to the listing session
+        :param timeout: seconds to wait for a single download, None to wait as long as it takes.
+                A session whose download timed out is not used again
+        :return: list of (Operation, exception) for the operations that failed
+        """
+        sessions = sessions or [self.session]
+        failures = []
+        for op in plan.removals:
+            try:
+                self._rm(op)
+            except OSError as e:
+                failures.append((op, e))
+        for op in plan.dir_removals:
+            self._rmdir(op)
+        lock = threading.Lock()
+        work = queue.Queue()
+        for op in plan.gets:
+            work.put(op)
+
+        def worker(session):
+            while True:
+                try:
+                    op = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self._get(session, op, timeout)
+                except (exc.DownloadError, exc.ConnectionError, OSError) as e:
+                    with lock:
+                        failures.append((op, e))
+                except exc.TimeoutError as e:
+                    # the download is still running, so the session is busy
+                    with lock:
+                        failures.append((op, e))
+                    return
+
+        threads = [threading.Thread(target=worker, args=(s,)) for s in sessions]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        while not work.empty():
+            # every session timed out
+            failures.append((work.get_nowait(), exc.TimeoutError("no session left")))
+
+        files = dict(plan.files)
+        dirs = dict(plan.dirs)
+        index = SyncIndex(self.index_path, files, dirs)
+        for op, e in failures:
+            if op.kind == Operation.GET:
+                files.pop(op.relpath, None)
+            else:
+                files[op.relpath] = self.index.files[op.relpath]
+            index.forget_dir(_parent(op.relpath))
+        index.save()
+        self.index = index
+        return failures
+
+    def sync(self, sessions=None, dry_run=False, timeout=None):
+        """ Plan and, unless dry_run is set, execute the sync
+        :param sessions: see execute
+        :param dry_run: only report the plan, leaving the target and index untouched
+        :param timeout: see execute
+        :return: (SyncPlan, failures)
+        """
+        plan = self.plan()
+        if dry_run:
+            return plan, []
+        return plan, self.execute(plan, sessions, timeout)
@@ -254,6 +254,102 @@ class LFTPTest(FTPServerBase):
         time.sleep(0.5)
         self.assertEqual(len(ftp.jobs), 1)
 
+    def test_recover_background_get(self):
+        f = tempfile.NamedTemporaryFile('w+b', dir=self.home)
+        f.file.write(os.urandom(1024 * 1024 * 5))
+        ftp = self.ftp
+        ftp.run("set net:limit-rate 10000")
+        fname = os.path.basename(f.name)
+        target_path = os.path.join(self.storage, fname)
+        transfer = ftp.get(fname, target_path, background=True)
+        time.sleep(0.5)
+        # the lftp process dies without being asked to
+        ftp.process.kill(9)
+        time.sleep(0.5)
+        jobs = ftp.jobs
+        self.assertTrue(ftp.is_running())
+        self.assertEqual(len(jobs), 1)
+        self.assertTrue(transfer.resume_cmd in jobs[transfer.job_no].text)
+        self.assertEqual(ftp.transfers, [transfer])
+
+    def test_queue(self):
+        ftp = self.ftp
+        ftp.queue_stop()
+        for name in ['a', 'b', 'c']:
+            ftp.queue_get(name, os.path.join(self.storage, name))
+        entries = ftp.list_queue()
+        self.assertEqual([e.position for e in entries], [1, 2, 3])
+        ftp.queue_move(3, 1)
+        self.assertTrue(ftp.list_queue()[0].cmd.startswith("get c"))
+        ftp.queue_delete(1)
+        self.assertEqual(len(ftp.list_queue()), 2)
+
+    def test_named_queue(self):
+        ftp = self.ftp
+        ftp.add_queue('slow', parallel=2)
+        ftp.queue_stop(queue='slow')
+        ftp.queue_get('a', os.path.join(self.storage, 'a'), queue='slow')
+        self.assertEqual(len(ftp.list_queue(queue='slow')), 1)
+        self.assertEqual(ftp.list_queue(), [])
+
+    def test_kill_named_queue(self):
+        ftp = self.ftp
+        ftp.add_queue('slow')
+        ftp.kill()
+        time.sleep(0.5)
+        self.assertFalse(ftp.queues['slow'].is_running())
+        ftp.reconnect()
+        self.assertEqual(ftp.list_queue(queue='slow'), [])
+
+    def test_queue_reorder(self):
+        ftp = self.ftp
+        ftp.queue_stop()
+        for name in ['a', 'b', 'c']:
+            ftp.queue_get(name, os.path.join(self.storage, name))
+        ftp.queue_reorder([3, 1])
+        cmds = [e.cmd.split()[1] for e in ftp.list_queue()]
+        self.assertEqual(cmds, ['c', 'a', 'b'])
+
+    def test_replace_named_queue(self):
+        ftp = self.ftp
+        ftp.add_queue('slow')
+        old = ftp.queues['slow']
+        ftp.add_queue('slow', parallel=2)
+        self.assertFalse(old.is_running())
+
+    def test_settings_replaced(self):
+        ftp = self.ftp
+        ftp.run("set net:limit-rate 1000")
+        ftp.run("set net:limit-rate 10000")
+        self.assertEqual(ftp.settings, {'net:limit-rate': "set net:limit-rate 10000"})
+
+    def test_finished_transfer_forgotten(self):
+        f = tempfile.NamedTemporaryFile('w+b', dir=self.home)
+        f.file.write(os.urandom(1024))
+        f.file.flush()
+        ftp = self.ftp
+        fname = os.path.basename(f.name)
+        transfer = ftp.get(fname, os.path.join(self.storage, fname), background=True)
+        time.sleep(1)
+        ftp.list()
+        self.assertTrue(transfer.done)
+        self.assertEqual(ftp.transfers, [])
+
+    def test_killed_transfer_not_resumed(self):
+        f = tempfile.NamedTemporaryFile('w+b', dir=self.home)
+        f.file.write(os.urandom(1024 * 1024 * 5))
+        ftp = self.ftp
+        ftp.run("set net:limit-rate 10000")
+        fname = os.path.basename(f.name)
+        transfer = ftp.get(fname, os.path.join(self.storage, fname), background=True)
+        time.sleep(0.5)
+        ftp.kill(transfer.job_no)
+        self.assertTrue(transfer.done)
+        self.assertEqual(ftp.transfers, [])
+        ftp.disconnect()
+        ftp.reconnect()
+        self.assertEqual(len(ftp.jobs), 0)
+
     def test_get_dir_failure(self):
         d = tempfile.mkdtemp(dir=self.home)
         f = tempfile.NamedTemporaryFile(mode='w+b', dir=d)
@@ -321,6 +417,52 @@ class LFTPTest(FTPServerBase):
         self.assertRaises(exc.DownloadError, lambda: self.ftp.rm(fname, recurse=False))
 
 
+class LFTPOptionsTest(unittest.TestCase):
+    def test_no_retries(self):
+        self.assertRaises(ValueError, lambda: lftp.LFTP('localhost', retries=0))
+
+
+class TransferCommandTest(unittest.TestCase):
+    def test_get_resume(self):
+        cmd = lftp.LFTP._get_cmd('a.txt', '/tmp/a.txt', delete_target=True, resume=True)
+        self.assertEqual(cmd, "get -c a.txt -o /tmp/a.txt")
+
+    def test_mirror_resume(self):
+        cmd = lftp.LFTP._mirror_cmd('pub', '/tmp/pub', parallel=3, resume=True)
+        self.assertEqual(cmd, "mirror --continue pub /tmp/pub --parallel=3")
+
+
+class QueueParserTest(unittest.TestCase):
+    def test_empty(self):
+        results = lftp.LFTP.parse_queue("")
+        self.assertEqual(results, [])
+
+    def test_queued(self):
+        text = """
+[0] queue (ftp://localhost)
+ftp://localhost/~
+\tNow executing: [1] mirror vax -- 2.8M/754M (0%) 4.3 KiB/s
+\t\t-[2] get base55.tgz
+\tCommands queued:
+\t 1. mirror zaurus
+\t 2. get bootxx
+        """
+        results = lftp.LFTP.parse_queue(text)
+        self.assertEqual([e.job_no for e in results], [1, 2, None, None])
+        self.assertEqual([e.position for e in results], [None, None, 1, 2])
+        self.assertEqual(results[3].cmd, "get bootxx")
+        self.assertEqual(results[0].cmd, "mirror vax")
+        self.assertEqual(results[0].status, "2.8M/754M (0%) 4.3 KiB/s")
+        self.assertEqual(results[1].status, None)
+        self.assertTrue(results[1].running)
+
+    def test_reorder(self):
+        self.assertEqual(lftp.LFTP._reorder_moves([3, 1]), [1, 3])
+        self.assertEqual(lftp.LFTP._reorder_moves([2, 4, 1]), [1, 4, 3])
+        self.assertEqual(lftp.LFTP._reorder_moves([]), [])
+        self.assertRaises(ValueError, lambda: lftp.LFTP._reorder_moves([2, 2]))
+
+
 class JobParserTest(unittest.TestCase):
     def test_empty(self):
         results = lftp.LFTP.parse_jobs("")
@@ -0,0 +1,177 @@
+import unittest
+from lftppy import sync
+from lftppy import exc
+import tempfile
+import shutil
+import os
+
+
+class FakeSession(object):
+    """ Answers listing commands from a dictionary of remote directory listings
+    """
+    def __init__(self, listings):
+        self.listings = listings
+        self.listed = []
+        self.fetched = []
+        self.failing = set()
+
+    def run(self, cmd, background=False, timeout=-1):
+        assert cmd.startswith("cls -1 -s --filesize ")
+        assert timeout is None
+        path = cmd.rsplit(' ', 1)[1].strip('"').rstrip('/')
+        self.listed.append(path)
+        return self.listings[path]
+
+    def get(self, rfile, lfile, delete_target=False, **kwargs):
+        rfile = rfile.strip('"')
+        lfile = lfile.strip('"')
+        if delete_target and os.path.exists(lfile):
+            os.remove(lfile)
+        assert not os.path.isdir(lfile)
+        if rfile in self.failing:
+            raise exc.DownloadError("get: Access failed: 550 %s" % rfile)
+        self.fetched.append(rfile)
+        with open(lfile, 'w') as f:
+            f.write("data")
+
+
+class ListingParserTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(sync.SyncPlanner.parse_listing(""), [])
+
+    def test_error(self):
+        text = "cls: Fatal error: max-retries exceeded"
+        self.assertRaises(exc.DownloadError, lambda: sync.SyncPlanner.parse_listing(text))
+
+    def test_done_notice(self):
+        text = "[0] Done (get a.txt -o /tmp/a.txt)\n  10 100 src/a.txt\n"
+        results = sync.SyncPlanner.parse_listing(text)
+        self.assertEqual(results, [('a.txt', False, 10, 100)])
+
+    def test_entries(self):
+        # cls -1 -s --filesize --date --time-style=+%s -F pub/
+        text = """
+        1445000000 pub/OpenBSD/
+ 2001660 1445000100 pub/base55.tgz
+       0 1445000150 pub/empty.txt
+      12 1445000300 pub/latest@
+        """
+        results = sync.SyncPlanner.parse_listing(text)
+        self.assertEqual(results, [
+            ('OpenBSD', True, 0, 1445000000),
+            ('base55.tgz', False, 2001660, 1445000100),
+            ('empty.txt', False, 0, 1445000150),
+        ])
+
+
+class SyncPlannerTest(unittest.TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+        self.listings = {
+            'src': "  10 100 src/a.txt\n     200 src/sub/\n",
+            'src/sub': "  30 300 src/sub/b.txt\n",
+        }
+        self.session = FakeSession(self.listings)
+
+    def tearDown(self):
+        shutil.rmtree(self.target)
+
+    def _planner(self):
+        return sync.SyncPlanner(self.session, 'src', self.target)
+
+    def test_first_sync(self):
+        plan, failures = self._planner().sync()
+        self.assertEqual(failures, [])
+        self.assertEqual(len(plan.gets), 2)
+        self.assertEqual(plan.size, 40)
+        self.assertEqual(sorted(self.session.fetched), ['src/a.txt', 'src/sub/b.txt'])
+        self.assertTrue(os.path.exists(os.path.join(self.target, 'sub', 'b.txt')))
+
+    def test_unchanged(self):
+        self._planner().sync()
+        self.session.listed = []
+        plan, _ = self._planner().sync()
+        self.assertEqual(plan.operations, [])
+        self.assertEqual(self.session.listed, ['src', 'src/sub'])
+
+    def test_deep_change(self):
+        self.listings['src/sub'] = "  30 300 src/sub/b.txt\n     400 src/sub/deep/\n"
+        self.listings['src/sub/deep'] = "     500 src/sub/deep/deeper/\n"
+        self.listings['src/sub/deep/deeper'] = ""
+        self._planner().sync()
+        # only the mtime of the directory holding the new file changes
+        self.listings['src/sub/deep/deeper'] = "   5 600 src/sub/deep/deeper/new\n"
+        self.listings['src/sub/deep'] = "     650 src/sub/deep/deeper/\n"
+        plan, _ = self._planner().sync()
+        self.assertEqual([str(op) for op in plan.operations],
+                         ['get sub/deep/deeper/new (5 bytes)'])
+
+    def test_failed_listing(self):
+        self._planner().sync()
+        self.listings['src'] = "cls: Access failed: No such file or directory\n"
+        self.assertRaises(exc.DownloadError, lambda: self._planner().sync())
+        self.assertTrue(os.path.exists(os.path.join(self.target, 'sub', 'b.txt')))
+
+    def test_empty_listing(self):
+        self._planner().sync()
+        self.listings['src'] = ""
+        self.assertRaises(exc.DownloadError, lambda: self._planner().sync())
+        self.assertTrue(os.path.exists(os.path.join(self.target, 'a.txt')))
+
+    def test_file_becomes_dir(self):
+        self._planner().sync()
+        self.listings['src'] = "     150 src/a.txt/\n     250 src/sub/\n"
+        self.listings['src/sub'] = "  30 300 src/sub/b.txt/\n"
+        self.listings['src/a.txt'] = "   5 160 src/a.txt/c\n"
+        self.listings['src/sub/b.txt'] = ""
+        plan, failures = self._planner().sync()
+        self.assertEqual(failures, [])
+        self.assertTrue(os.path.exists(os.path.join(self.target, 'a.txt', 'c')))
+        # and back again
+        self.listings['src'] = "  10 170 src/a.txt\n     250 src/sub/\n"
+        plan, failures = self._planner().sync()
+        self.assertEqual(failures, [])
+        self.assertEqual(sorted(str(op) for op in plan.operations),
+                         ['get a.txt (10 bytes)', 'rm a.txt/c', 'rmdir a.txt'])
+        self.assertTrue(os.path.isfile(os.path.join(self.target, 'a.txt')))
+
+    def test_changed_and_removed(self):
+        self._planner().sync()
+        self.listings['src'] = "  11 100 src/a.txt\n     250 src/sub/\n"
+        self.listings['src/sub'] = ""
+        plan, _ = self._planner().sync()
+        self.assertEqual([str(op) for op in plan.operations],
+                         ['get a.txt (11 bytes)', 'rm sub/b.txt'])
+        self.assertFalse(os.path.exists(os.path.join(self.target, 'sub', 'b.txt')))
+
+    def test_dry_run(self):
+        plan, _ = self._planner().sync(dry_run=True)
+        self.assertEqual(plan.summary(), "get 2 files (40 bytes), rm 0 files")
+        self.assertEqual(self.session.fetched, [])
+        self.assertFalse(os.path.exists(os.path.join(self.target, sync.SyncPlanner.INDEX_NAME)))
+
+    def test_failed_get(self):
+        self._planner().sync()
+        self.listings['src'] = "  11 150 src/a.txt\n     200 src/sub/\n"
+        self.session.failing.add('src/a.txt')
+        plan, failures = self._planner().sync()
+        self.assertEqual([str(op) for op, e in failures], ['get a.txt (11 bytes)'])
+        # the local copy is gone, so the next sync has to fetch it again
+        self.session.failing.clear()
+        plan, failures = self._planner().sync()
+        self.assertEqual([str(op) for op in plan.operations], ['get a.txt (11 bytes)'])
+        self.assertEqual(failures, [])
+
+    def test_rebuild(self):
+        os.makedirs(os.path.join(self.target, 'sub'))
+        os.makedirs(os.path.join(self.target, 'gone'))
+        for relpath, mtime in [('a.txt', 100), ('sub/b.txt', 300), ('gone/c.txt', 400)]:
+            lfile = os.path.join(self.target, relpath)
+            with open(lfile, 'w') as f:
+                f.write("x" * 10)
+            os.utime(lfile, (mtime, mtime))
+        plan, _ = sync.SyncPlanner(self.session, 'src', self.target, rebuild=True).sync()
+        self.assertEqual(sorted(str(op) for op in plan.operations),
+                         ['get sub/b.txt (30 bytes)', 'rm gone/c.txt', 'rmdir gone'])
+        self.assertEqual(sorted(self.session.listed), ['src', 'src/sub'])
+        self.assertFalse(os.path.exists(os.path.join(self.target, 'gone')))